@@ -1,12 +1,14 @@
 import os
+import sys
 import json
 import uuid
 import time
 import boto3
 import socket
 import logging
-import urllib.request
-import urllib.error
+import urllib.parse
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, wait
 
 
 logger = logging.getLogger()
@@ -19,196 +21,345 @@ DEFAULT_CHECK_URLS = ["https://www.example.com", "https://www.google.com"]
 DEFAULT_REQUEST_TIMEOUT = 8
 DEFAULT_UNHEALTHY_THRESHOLD = 3
 
+# Resolved IP address of the checked hosts reused across checks and warm invocations, so DNS lookups are not part of
+# every check nor its latency
+dns_cache = {}
+
+# Step Functions client lazily created on first failover and reused across warm invocations
+sfn_client = None
+
+# Static part of the embedded metrics records, so they are not rebuilt on every emission. CloudWatch only extracts
+# metrics from log events that include the directive, so it is kept as small as possible instead of being dropped:
+# StorageResolution is omitted since standard resolution of one minute is the default
+# https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+CONNECTIVITY_METRIC_DIRECTIVE = {
+    "Namespace": "NatInstances",
+    "Dimensions": [["AvailabilityZone", "Region", "Url"]],
+    "Metrics": [{"Name": "NatLatency", "Unit": "Seconds"}],
+}
+FAILOVER_METRIC_DIRECTIVE = {
+    "Namespace": "NatInstances",
+    "Dimensions": [["Region"]],
+    "Metrics": [{"Name": "NatFailover", "Unit": "Unit"}],
+}
+
+
+def emit_metric_records(metric_records: list) -> None:
+    """
+    Writes the embedded metrics records as compact JSON log lines with a single write, so there is no whitespace to
+    serialize nor ingest.
+
+    Parameters
+    ----------
+    metric_records : list
+        Embedded metrics records to write in the function logs
+    """
+    sys.stdout.write("".join(json.dumps(record, separators=(",", ":")) + "\n" for record in metric_records))
+
 
-def emit_connectivity_metric(url: str, latency: float, context: dict, availability_zone: str) -> None:
+def emit_connectivity_metric(urls: list, latencies: list, region: str, availability_zone: str) -> None:
     """
     Emits CloudWatch metric using embeded metrics in logs so we can measure the connectivity latency of each
-    private subnet in our VPCs.
+    private subnet in our VPCs. All the successful checks of a round are emitted at once, with a record per url since
+    embedded metrics dimensions take a single value per record.
 
     Parameters
     ----------
-    url : str
-        url dimension of the connectivity metric
-    latency : float
-        amount of seconds that the connectivity request took
-    context : dict
-        Lambda context passed to the function used to fetch function region which is another dimension
+    urls : list
+        urls successfully checked, in the same order as the latencies
+    latencies : list
+        amount of seconds that each connectivity request took
+    region : str
+        Region where the function runs, which is another dimension
     availability_zone : str
         Availability zone to which this metric is referred to
     """
-    region = context.invoked_function_arn.split(":")[3]
-
-    metric_record = {
-        "_aws": {
-            "Timestamp": int(time.time() * 1000),
-            "CloudWatchMetrics": [
-                {
-                    "Namespace": "NatInstances",
-                    "Dimensions": [["AvailabilityZone", "Region", "Url"]],
-                    "Metrics": [
-                        {
-                            "Name": "NatLatency",
-                            "Unit": "Seconds",
-                            "StorageResolution": 60,  # Standard resolution of one minute,
-                        },
-                    ],
-                },
-            ],
-        },
-        "AvailabilityZone": availability_zone,
-        "Region": region,
-        "Url": url,
-        "NatLatency": latency,
-    }
+    timestamp = int(time.time() * 1000)
+    metric_records = [
+        {
+            "_aws": {
+                "Timestamp": timestamp,
+                "CloudWatchMetrics": [CONNECTIVITY_METRIC_DIRECTIVE],
+            },
+            "AvailabilityZone": availability_zone,
+            "Region": region,
+            "Url": url,
+            "NatLatency": latency,
+        }
+        for url, latency in zip(urls, latencies)
+    ]
     # Emit raw embbeded CloudWatch metrics
-    # https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
-    print(json.dumps(metric_record, default=str))
+    emit_metric_records(metric_records)
 
 
-def emit_failover_metric(context: dict) -> None:
+def emit_failover_metric(region: str) -> None:
     """
     Emits CloudWatch metric using embeded metrics in logs so we can know if the Failover processed was triggered
     because of connection issues.
 
     Parameters
     ----------
-    context : dict
-        Lambda context passed to the function used to fetch function region which is a dimension
+    region : str
+        Region where the function runs, which is the metric dimension
     """
-    region = context.invoked_function_arn.split(":")[3]
-
     metric_record = {
         "_aws": {
             "Timestamp": int(time.time() * 1000),
-            "CloudWatchMetrics": [
-                {
-                    "Namespace": "NatInstances",
-                    "Dimensions": [["Region"]],
-                    "Metrics": [
-                        {
-                            "Name": "NatFailover",
-                            "Unit": "Unit",
-                            "StorageResolution": 60,  # Standard resolution of one minute,
-                        },
-                    ],
-                },
-            ],
+            "CloudWatchMetrics": [FAILOVER_METRIC_DIRECTIVE],
         },
         "Region": region,
         "NatFailover": 1,
     }
     # Emit raw embbeded CloudWatch metrics
-    # https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
-    print(json.dumps(metric_record, default=str))
+    emit_metric_records([metric_record])
 
 
-def check_connection(check_url: str, request_timeout: int, context: dict, availability_zone: str) -> bool:
+def resolve_host(host: str) -> str:
     """
-    Checks the connectivity of provided url trying to open url and capturing errors in case they fail.
+    Resolves the IP address of provided host, using the cached one if the host was already resolved.
 
     Parameters
     ----------
-    check_url : str
-        Url to check the connectivity to
-    request_timeout : int
-        Time in seconds to wait for the requests before timing out
-    context : dict
-        Lambda context passed to the function used to pass to the 'emit_connectivity_metric' method
-    availability_zone : str
-        Availability zone to which the connectivity is checked to
+    host : str
+        Host name to resolve
+
+    Returns
+    -------
+    str
+        The IP address of the host
     """
-    try:
-        start_time = time.time()
-        urllib.request.urlopen(check_url, timeout=request_timeout)
-        end_time = time.time()
+    ip_address = dns_cache.get(host)
+    if not ip_address:
+        ip_address = socket.gethostbyname(host)
+        dns_cache[host] = ip_address
+    return ip_address
 
-        try:
-            latency = end_time - start_time
-            emit_connectivity_metric(check_url, latency, context, availability_zone)
-        except Exception as error:
-            logger.warning(f"Metric failed to emit: {error}")
 
-    except (urllib.error.URLError, urllib.error.HTTPError) as error:
-        logger.error(f"error connecting to {check_url}: {error}")
-        return False
-    except socket.timeout as error:
-        logger.error(f"timeout error connecting {check_url}: {error}")
-        return False
+def check_connection(check_url: str, request_timeout: int) -> Optional[float]:
+    """
+    Checks the connectivity of provided url opening a TCP connection to its host and capturing errors in case they
+    fail. Reaching the host is enough to know that internet access through the NAT works, so there is no need to
+    pay for the TLS handshake and the HTTP request; the url is kept to identify the checked endpoint.
 
-    return True
+    Parameters
+    ----------
+    check_url : str
+        Url to check the connectivity to
+    request_timeout : int
+        Time in seconds to wait for the connection before timing out
 
+    Returns
+    -------
+    float, optional
+        Amount of seconds that the connection took or None if connection failed
+    """
+    parsed_url = urllib.parse.urlparse(check_url)
+    port = parsed_url.port or (80 if parsed_url.scheme == "http" else 443)
 
-def invoke_failover(context: dict, availability_zone: str, failover_state_machine_arn: str) -> None:
+    try:
+        resolution_start_time = time.monotonic()
+        ip_address = resolve_host(parsed_url.hostname)
+
+        # Name resolution cannot be given a timeout, so the connection only gets the time left of the check timeout
+        remaining_timeout = request_timeout - (time.monotonic() - resolution_start_time)
+        if remaining_timeout <= 0:
+            raise socket.timeout(f"resolving {parsed_url.hostname} took longer than {request_timeout} seconds")
+
+        start_time = time.monotonic()
+        connection = socket.create_connection((ip_address, port), timeout=remaining_timeout)
+        end_time = time.monotonic()
+        connection.close()
+
+    except OSError as error:  # Timeouts and name resolution errors are OSError subclasses too
+        # Forget the resolved address on failures, so the host is resolved again in case its address changed
+        dns_cache.pop(parsed_url.hostname, None)
+        logger.error("error connecting to %s: %s", check_url, error)
+        return None
+
+    return end_time - start_time
+
+
+def invoke_failover(
+    region: str,
+    availability_zone: str,
+    failover_state_machine_arn: str,
+    failover_state_machine_region: str,
+) -> None:
     """
     Method to invoke the NAT instances failover state machine that will change private subnets routes to use
     NAT Gateway instead of NAT instances.
 
     Parameters
     ----------
-    context : dict
-        Lambda context passed to the function used to pass to the 'emit_failover_metric' method
+    region : str
+        Region where the function runs, used to pass to the 'emit_failover_metric' method
     availability_zone : str
         Availability zone causing the failover triggering
     failover_state_machine_arn : str
         ARN of the failover state machine
+    failover_state_machine_region : str
+        Region where the failover state machine is deployed
     """
-    region = failover_state_machine_arn.split(":")[3]
+    global sfn_client
+    if sfn_client is None:
+        sfn_client = boto3.client("stepfunctions", region_name=failover_state_machine_region)
 
-    client = boto3.client("stepfunctions", region_name=region)
-
-    client.start_execution(
+    sfn_client.start_execution(
         stateMachineArn=failover_state_machine_arn,
         name=f"ConnectionFailing_{availability_zone}_{uuid.uuid4()}",
     )
     logger.warning("Triggered Failover state machine")
 
     try:
-        emit_failover_metric(context)
+        emit_failover_metric(region)
     except Exception as error:
-        logger.warning(f"Metric failed to emit: {error}")
+        logger.warning("Metric failed to emit: %s", error)
+
+
+def harvest_round(
+    check_urls: list,
+    submitted_at: float,
+    futures: list,
+    request_timeout: int,
+    region: str,
+    availability_zone: str,
+) -> int:
+    """
+    Waits for the checks of a round to finish and emits the latency metric of the succeeded ones. Checks not
+    finished in time or failed unexpectedly are counted as failed ones, so a degraded network makes the round
+    unhealthy instead of failing the whole invocation.
+
+    Parameters
+    ----------
+    check_urls : list
+        Urls checked in the round, in the same order as the futures
+    submitted_at : float
+        Monotonic time when the round checks were submitted
+    futures : list
+        Futures of the round checks, that result in the connection latency or None if connection failed
+    request_timeout : int
+        Time in seconds that the checks wait for the connection before timing out
+    region : str
+        Region where the function runs, used to pass to the 'emit_connectivity_metric' method
+    availability_zone : str
+        Availability zone to which the connectivity is checked to
+
+    Returns
+    -------
+    int
+        Number of failed checks in the round
+    """
+    # The checks timeout counts from the round submission, not from the harvest, that happens an interval later
+    wait(futures, timeout=max(0, submitted_at + request_timeout + 2 - time.monotonic()))
+
+    latencies = []
+    for url, future in zip(check_urls, futures):
+        if not future.done():
+            logger.error("timeout error checking %s: check did not finish in %s seconds", url, request_timeout + 2)
+            latencies.append(None)
+        elif future.exception():
+            logger.error("error checking %s: %s", url, future.exception())
+            latencies.append(None)
+        else:
+            latencies.append(future.result())
+
+    succeeded_checks = [(url, latency) for url, latency in zip(check_urls, latencies) if latency is not None]
+    if succeeded_checks:
+        try:
+            emit_connectivity_metric(
+                [url for url, _ in succeeded_checks],
+                [latency for _, latency in succeeded_checks],
+                region,
+                availability_zone,
+            )
+        except Exception as error:
+            logger.warning("Metric failed to emit: %s", error)
+
+    return latencies.count(None)
 
 
 def handler(event: dict, context: dict) -> None:
     """
     Connectivity checker Lambda handler function. It will check the provided urls at regular intervals and will emit
-    metrics to measure connectivity reliability. It also triggers the Failover state machine in case the
-    unhealthy threshold is exceeded.
+    metrics to measure connectivity reliability. It also triggers the Failover state machine in case all the urls
+    checks fail during as many consecutive rounds as the unhealthy threshold.
 
     Parameters
     ----------
     event : dict
         Lambda input event - not used at this time
     context : dict
-        Lambda context used to pass to the 'emit_connectivity_metric' method
+        Lambda context used to fetch the function region
     """
     # Fetch configuration values from environment variables or failover to default values
     check_interval = int(os.getenv("CONNECTIVITY_CHECK_INTERVAL", DEFAULT_CONNECTIVITY_CHECK_INTERVAL))
     check_time_limit = int(os.getenv("FUNCTION_TIMEOUT", DEFAULT_FUNCTION_TIMEOUT))
-    check_urls = "CHECK_URLS" in os.environ and os.getenv("CHECK_URLS").split(",") or DEFAULT_CHECK_URLS
+    raw_check_urls = os.environ.get("CHECK_URLS")
+    check_urls = [url.strip() for url in raw_check_urls.split(",") if url.strip()] if raw_check_urls else []
+    check_urls = check_urls or DEFAULT_CHECK_URLS
     request_timeout = int(os.getenv("REQUEST_TIMEOUT", DEFAULT_REQUEST_TIMEOUT))
     unhealthy_threshold = int(os.getenv("UNHEALTHY_THRESHOLD", DEFAULT_UNHEALTHY_THRESHOLD))
     failover_state_machine_arn = os.getenv("FAILOVER_STATE_MACHINE_ARN", "unknown")
     availability_zone = os.getenv("AVAILABILITY_ZONE", "unknown")
 
-    failed_checks_count = 0
-    runs_count = 0
+    # Compute derived values once, so they are not computed again on every round
+    region = context.invoked_function_arn.split(":")[3]
+    failover_state_machine_region = (
+        failover_state_machine_arn.split(":")[3] if failover_state_machine_arn != "unknown" else region
+    )
     urls_count = len(check_urls)
 
-    runs_limit = (check_time_limit / check_interval) - 1
-
-    while runs_count < runs_limit:
-        if failed_checks_count >= (unhealthy_threshold * urls_count):
-            invoke_failover(context, availability_zone, failover_state_machine_arn)
-            raise RuntimeError("Unhealthy threshold reached. Triggered Failover")
+    unhealthy_rounds_count = 0
+    runs_count = 0
 
-        start_time = time.time()
-        for url in check_urls:
-            if not check_connection(url, request_timeout, context, availability_zone):
-                failed_checks_count += 1
+    runs_limit = (check_time_limit // check_interval) - 1
 
-        end_time = time.time()
-        wait_time = check_interval - (end_time - start_time)
-        wait_time = 0 if wait_time < 0 else wait_time  # sanity check to ensure wait_time is not negative
-        time.sleep(wait_time)
+    # Rounds are scheduled against absolute deadlines of a monotonic clock, so the checks cadence does not drift
+    # with the rounds duration nor is affected by wall clock adjustments
+    deadline = time.monotonic()
 
-        runs_count += 1
+    # Checks are network bound, so run them concurrently to make each round last as much as the slowest url. Rounds
+    # are also pipelined: every deadline submits a new round and then harvests the previous one, which had a whole
+    # interval to finish, so there is room for two rounds of checks running at the same time
+    executor = ThreadPoolExecutor(max_workers=2 * urls_count)
+    pending_round = None
+    try:
+        # Keep looping after the last run until its round is harvested, so its checks are measured too
+        while runs_count < runs_limit or pending_round:
+            current_round = None
+            if runs_count < runs_limit:
+                current_round = (
+                    time.monotonic(),
+                    [executor.submit(check_connection, url, request_timeout) for url in check_urls],
+                )
+
+            if pending_round:
+                submitted_at, futures = pending_round
+                round_failures = harvest_round(
+                    check_urls, submitted_at, futures, request_timeout, region, availability_zone
+                )
+                # Only rounds where every url fails count as unhealthy, so a single flaky url cannot trigger failover
+                unhealthy_rounds_count = unhealthy_rounds_count + 1 if round_failures == urls_count else 0
+            pending_round = current_round
+
+            if unhealthy_rounds_count >= unhealthy_threshold:
+                invoke_failover(region, availability_zone, failover_state_machine_arn, failover_state_machine_region)
+                raise RuntimeError("Unhealthy threshold reached. Triggered Failover")
+
+            if pending_round:
+                deadline += check_interval
+                wait_time = deadline - time.monotonic()
+                if wait_time > 0:
+                    time.sleep(wait_time)
+                else:
+                    # The round overran the interval, so restart the cadence from now instead of running the next
+                    # rounds back to back until catching up with the missed deadlines
+                    deadline = time.monotonic()
+
+            runs_count += 1
+    finally:
+        # Do not wait for checks stuck beyond their timeout (e.g. resolving a host) nor for the round submitted
+        # before the failover. Their threads are not joined, so they may keep running into the following warm
+        # invocations until the call they are stuck in gives up; each invocation uses its own executor, so they
+        # never take the workers of the new checks
+        executor.shutdown(wait=False, cancel_futures=True)
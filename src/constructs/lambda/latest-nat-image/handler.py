@@ -1,4 +1,5 @@
 import os
+import time
 import logging
 import boto3
 
@@ -10,12 +11,17 @@ client = boto3.client("ec2")
 
 # Fetch configuration values from environment variables or failover to default values
 NAT_IMAGES_AMI_NAME_TAG_PATTERN = os.getenv("NAT_IMAGES_AMI_NAME_TAG_PATTERN", "NAT-*")
+# Seconds that the latest image ID is kept in warm containers before fetching it again. It is below the time that the
+# maintenance workflow waits for a new image to be built, so a new image is not hidden by a cached one
+LATEST_IMAGE_CACHE_TTL = int(os.getenv("LATEST_IMAGE_CACHE_TTL", 300))
+
+latest_image_cache = {"image_id": None, "expires": 0.0}
 
 
 def handler(event: dict, context: dict):
     """
     Get latest NAT instance image ID function. It get all owned NAT instances images (using tags and name to filter)
-    and returns only the most recent one.
+    and returns only the most recent one, which is cached in warm containers during 'LATEST_IMAGE_CACHE_TTL' seconds.
 
     Parameters
     ----------
@@ -29,6 +35,11 @@ def handler(event: dict, context: dict):
     str
         The latest AMI ID of the NAT instances images
     """
+    now = time.monotonic()
+    if latest_image_cache["image_id"] and now < latest_image_cache["expires"]:
+        logger.info(f"Latest image ID is '{latest_image_cache['image_id']}' (cached)")
+        return latest_image_cache["image_id"]
+
     logger.info("Fetching Latest NAT instance image")
 
     aws_account_id = context.invoked_function_arn.split(":")[4]
@@ -44,6 +55,11 @@ def handler(event: dict, context: dict):
             "Name": "tag:CreatedBy",
             "Values": ["EC2 Image Builder"],
         },
+        {
+            # Filter out pending or failed images server side, so they are neither returned nor parsed
+            "Name": "state",
+            "Values": ["available"],
+        },
     ]
 
     response = client.describe_images(
@@ -62,11 +78,15 @@ def handler(event: dict, context: dict):
         )
         existing_images.extend(response["Images"])
 
-    # Sort the returned list descending by CreationDate so the first element is the most recent one
-    images = sorted(existing_images, key=lambda field: field["CreationDate"], reverse=True)
+    if not existing_images:
+        raise RuntimeError(f"No NAT instance images found matching '{NAT_IMAGES_AMI_NAME_TAG_PATTERN}'")
 
-    latest_image_id = images[0]["ImageId"]
+    # Only the most recent image is needed, so get the one with the max CreationDate rather than sorting them all
+    latest_image_id = max(existing_images, key=lambda image: image["CreationDate"])["ImageId"]
 
     logger.info(f"Latest image ID is '{latest_image_id}'")
 
+    latest_image_cache["image_id"] = latest_image_id
+    latest_image_cache["expires"] = now + LATEST_IMAGE_CACHE_TTL
+
     return latest_image_id